@@ -1,43 +1,51 @@
 from __future__ import annotations
 
+import concurrent.futures
+import contextlib
 import enum
-import hashlib
-import io
+import functools
 import os.path
-import platform
 import re
-import secrets
 import shutil
-import stat
 import sys
-import tarfile
-import urllib.request
-import zipfile
+import threading
+from collections.abc import Generator
+from collections.abc import Iterable
+from typing import Any
+from typing import IO
 from typing import NamedTuple
+from typing import TYPE_CHECKING
 
 from setuptools import Command
 from setuptools import Distribution
 
+if TYPE_CHECKING:
+    import gzip
+    import http.client
+
 _Key = enum.Enum('_Key', 'os_name sys_platform platform_machine _internal')
 _KEY_DISPLAY = f'({"|".join(k for k in _Key.__members__ if k != "_internal")})'
 
 
-def _default_env() -> dict[_Key, str]:
-    return {
-        _Key.os_name: os.name,
-        _Key.sys_platform: sys.platform,
-        _Key.platform_machine: platform.machine(),
-        _Key._internal: 'hellohello',
-    }
+@functools.lru_cache(maxsize=1)
+def _default_env() -> frozenset[tuple[_Key, str]]:
+    import platform
+
+    return frozenset((
+        (_Key.os_name, os.name),
+        (_Key.sys_platform, sys.platform),
+        (_Key.platform_machine, platform.machine()),
+        (_Key._internal, 'hellohello'),
+    ))
 
 
 class Marker(NamedTuple):
     """simplified PEP 508 Marker with only `and`"""
     orig: str
-    parts: tuple[tuple[_Key, str], ...]
+    parts: frozenset[tuple[_Key, str]]
 
-    def evaluate(self, env: dict[_Key, str]) -> bool:
-        return all(env[k] == v for k, v in self.parts)
+    def evaluate(self, env: frozenset[tuple[_Key, str]]) -> bool:
+        return self.parts <= env
 
     @classmethod
     def parse(cls, s: str) -> Marker:
@@ -61,32 +69,64 @@ class Marker(NamedTuple):
                     f'invalid marker part: '
                     f'expected: `{_KEY_DISPLAY} == "..."` got: `{chunk}`',
                 )
-            ret.append((_Key[parts[0]], parts[2][1:-1]))
-        return cls(orig=s, parts=tuple(ret))
+            ret.append((_Key[parts[0]], sys.intern(parts[2][1:-1])))
+        return cls(orig=s, parts=frozenset(ret))
 
     def __repr__(self) -> str:
         return f'{type(self).__name__}.parse({self.orig!r})'
 
 
-def _extract_noop(bts: bytes, src: str) -> bytes:
-    return bts
+_SPOOL_SIZE = 16 * 1024 * 1024
+
 
+def _gzip_open(fileobj: IO[bytes]) -> gzip.GzipFile:
+    try:
+        from isal import igzip
+    except ImportError:
+        import gzip
+        return gzip.open(fileobj, 'rb')
+    else:  # pragma: no cover (optional dependency)
+        # ISA-L's inflate is several times faster than zlib's
+        return igzip.open(fileobj, 'rb')
 
-def _extract_tar(bts: bytes, src: str) -> bytes:
-    with io.BytesIO(bts) as bio:
-        with tarfile.open(fileobj=bio) as tarf:
-            member = tarf.extractfile(src)
-            assert member is not None, src
-            return member.read()
 
+def _extract_tar(fileobj: IO[bytes], src: str) -> bytes:
+    import tarfile
+    import tempfile
+
+    is_gzip = fileobj.read(2) == b'\x1f\x8b'
+    fileobj.seek(0)
+
+    with contextlib.ExitStack() as ctx:
+        stream = fileobj
+        if is_gzip:
+            # decompress gzip ourselves exactly once (so the faster
+            # implementation can be used) into a seekable file -- seeking
+            # backwards in a gzip stream decompresses again from the start
+            stream = ctx.enter_context(
+                tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE),
+            )
+            with _gzip_open(fileobj) as gz:
+                shutil.copyfileobj(gz, stream, _CHUNK_SIZE)
+            stream.seek(0)
 
-def _extract_zip(bts: bytes, src: str) -> bytes:
-    with io.BytesIO(bts) as bio:
-        with zipfile.ZipFile(bio) as zipf:
-            return zipf.read(src)
+        # random access: `extractfile` resolves (sym)link members and, like
+        # extraction, uses the last copy of a duplicated name
+        tarf = ctx.enter_context(tarfile.open(fileobj=stream))
+        extracted = tarf.extractfile(src)
+        assert extracted is not None, src
+        return extracted.read()
 
 
-_EXTRACT = {'noop': _extract_noop, 'tar': _extract_tar, 'zip': _extract_zip}
+def _extract_zip(fileobj: IO[bytes], src: str) -> bytes:
+    import zipfile
+
+    # zip needs random access to its central directory at the end of the file
+    with zipfile.ZipFile(fileobj) as zipf:
+        return zipf.read(src)
+
+
+_EXTRACT = {'tar': _extract_tar, 'zip': _extract_zip}
 
 
 class Archive(NamedTuple):
@@ -103,29 +143,74 @@ class File(NamedTuple):
     markers: tuple[Marker, ...] = ()
 
 
-_SECTION = re.compile(r'^\[([^]\n]+)\]$', re.MULTILINE)
+def _sections(s: str) -> Generator[tuple[str | None, str], None, None]:
+    """split ini-like `s` into `(path, body)` in a single pass
 
+    only lines starting with `[` are inspected, bodies are sliced out of `s`
+    directly.  text before the first section is yielded with a path of `None`
+    """
+    path = None
+    body_start = line_start = 0
+    while True:
+        line_end = s.find('\n', line_start)
+        if line_end == -1:
+            line_end = len(s)
 
-def _parse(s: str | None, section: str) -> tuple[File, ...]:
-    parts = iter(_SECTION.split((s or '').strip()))
+        name = s[line_start:line_end]
+        if (
+                len(name) > 2 and
+                name[0] == '[' and
+                name[-1] == ']' and
+                ']' not in name[1:-1]
+        ):
+            yield path, s[body_start:line_start]
+            path, body_start = name[1:-1], line_end + 1
+
+        line_start = s.find('\n[', line_start) + 1
+        if line_start == 0:
+            break
+    yield path, s[body_start:]
 
-    junk = next(parts)
-    if junk != '':
-        raise ValueError(f'{section}: unexpected value: {junk!r}')
 
+# non-empty, whole bytes, and safe to use as a (cache) filename
+_HEX = re.compile('(?:[0-9a-fA-F]{2})+')
+
+# `key = value` (whitespace stripped), or a whole line as `key` when no `=`
+_KEY_VALUE = re.compile(
+    r'^[^\S\n]*(.*?)[^\S\n]*(?:=[^\S\n]*(.*?))?[^\S\n]*$',
+    re.MULTILINE,
+)
+
+# values which are typically repeated across many files
+_INTERNED_KEYS = frozenset(('extract', 'extract_path', 'group'))
+
+
+def _parse(s: str | None, section: str) -> tuple[File, ...]:
     ret = []
-    for path, body in zip(parts, parts):
+    for path, body in _sections((s or '').strip()):
+        if path is None:
+            if body != '':
+                raise ValueError(f'{section}: unexpected value: {body!r}')
+            continue
+
         values = {}
         markers = []
-        for line in body.strip().splitlines():
-            k, v = line.split('=', 1)
-            k, v = k.strip(), v.strip()
+        for match in _KEY_VALUE.finditer(body):
+            k, v = match.groups()
+            if v is None:
+                if k:
+                    raise ValueError(
+                        f'{section}[{path}]{k}: expected `key = value`',
+                    )
+                continue
 
             if k == 'marker':
                 markers.append(Marker.parse(v))
             elif k in {'url', 'sha256', 'extract', 'extract_path', 'group'}:
                 if k in values:
                     raise ValueError(f'{section}[{path}]{k}: duplicate key')
+                elif k in _INTERNED_KEYS:
+                    values[k] = sys.intern(v)
                 else:
                     values[k] = v
             else:
@@ -140,6 +225,12 @@ def _parse(s: str | None, section: str) -> tuple[File, ...]:
         if url is None or sha256 is None:
             raise ValueError(f'{section}[{path}]: missing `url` + `sha256`')
 
+        if not _HEX.fullmatch(sha256):
+            raise ValueError(
+                f'{section}[{path}]sha256: '
+                f'expected hex digest, got {sha256!r}',
+            )
+
         if bool(extract) != bool(extract_path):
             raise ValueError(
                 f'{section}[{path}]: missing `extract` + `extract_path`',
@@ -148,7 +239,7 @@ def _parse(s: str | None, section: str) -> tuple[File, ...]:
         if extract is not None and extract not in _EXTRACT:
             raise ValueError(
                 f'{section}[{path}]extract: unexpected value {extract!r}, '
-                f'({", ".join(sorted(_EXTRACT.keys() - {"noop"}))})',
+                f'({", ".join(sorted(_EXTRACT))})',
             )
 
         if extract is not None and extract_path is not None:
@@ -161,7 +252,7 @@ def _parse(s: str | None, section: str) -> tuple[File, ...]:
 
         ret.append(
             File(
-                path=path,
+                path=sys.intern(path),
                 url=url,
                 sha256=sha256,
                 archive=archive,
@@ -174,6 +265,8 @@ def _parse(s: str | None, section: str) -> tuple[File, ...]:
 
 
 def _filter(src: tuple[File, ...], section: str) -> tuple[File, ...]:
+    import platform
+
     env = _default_env()
 
     ret = [
@@ -210,20 +303,199 @@ def _filter(src: tuple[File, ...], section: str) -> tuple[File, ...]:
     return tuple(ret)
 
 
-def _download(f: File, base: str) -> None:
-    req = urllib.request.Request(f.url, headers={'User-Agent': __name__})
-    resp = urllib.request.urlopen(req)
-    contents = resp.read()
-    got = hashlib.sha256(contents).hexdigest()
-    if not secrets.compare_digest(got, f.sha256):
-        raise ValueError(f'{f.path}: checksum mismatch {got=} {f.sha256=}')
-
-    contents = _EXTRACT[f.archive.strategy](contents, f.archive.path)
+# the checksum is of the raw bytes: never let the server re-encode them
+_HEADERS = {'User-Agent': __name__, 'Accept-Encoding': 'identity'}
+_SCHEMES = frozenset(('http', 'https'))
+_REDIRECT_STATUSES = frozenset((301, 302, 303, 307, 308))
+_MAX_REDIRECTS = 10
+_CHUNK_SIZE = 256 * 1024
+
+
+# idle keep-alive connections, shared between the download threads
+_IDLE: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+_IDLE_LOCK = threading.Lock()
+
+
+def _close_idle_connections() -> None:
+    with _IDLE_LOCK:
+        for conns in _IDLE.values():
+            for conn in conns:
+                conn.close()
+        _IDLE.clear()
+
+
+def _request(
+        key: tuple[str, str],
+        path: str,
+) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+    with _IDLE_LOCK:
+        idle = _IDLE.get(key)
+        conn = idle.pop() if idle else None
+
+    if conn is not None:
+        try:
+            conn.request('GET', path, headers=_HEADERS)
+            return conn, conn.getresponse()
+        except ConnectionError:  # pragma: no cover (stale keep-alive)
+            conn.close()
+
+    import http.client
+
+    scheme, netloc = key
+    conn_cls = {
+        'http': http.client.HTTPConnection,
+        'https': http.client.HTTPSConnection,
+    }[scheme]
+    conn = conn_cls(netloc)
+    conn.request('GET', path, headers=_HEADERS)
+    return conn, conn.getresponse()
+
+
+@contextlib.contextmanager
+def _urlopen(url: str) -> Generator[Any, None, None]:
+    """like `urllib.request.urlopen` but reuses http(s) connections"""
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+
+    scheme = urllib.parse.urlsplit(url).scheme
+    if scheme not in _SCHEMES or scheme in urllib.request.getproxies():
+        req = urllib.request.Request(url, headers=_HEADERS)
+        with urllib.request.urlopen(req) as resp:
+            yield resp
+        return
+
+    for _ in range(_MAX_REDIRECTS):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(
+            ('', '', parts.path or '/', parts.query, ''),
+        )
+        conn, resp = _request(key, path)
+        try:
+            location = resp.headers.get('Location')
+            if resp.status in _REDIRECT_STATUSES and location is not None:
+                new_url = urllib.parse.urljoin(url, location)
+                if urllib.parse.urlsplit(new_url).scheme not in _SCHEMES:
+                    raise urllib.error.HTTPError(
+                        url,
+                        resp.status,
+                        f'{resp.reason} - '
+                        f'Redirection to url {new_url!r} is not allowed',
+                        resp.headers,
+                        None,
+                    )
+                resp.read()
+                url = new_url
+            elif not 200 <= resp.status < 300:
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.headers, None,
+                )
+            else:
+                yield resp
+                return
+        finally:
+            # a fully read response leaves the connection ready for reuse
+            if resp.isclosed():
+                with _IDLE_LOCK:
+                    _IDLE.setdefault(key, []).append(conn)
+            else:
+                resp.close()
+                conn.close()
+
+    raise ValueError(f'{url}: too many redirects')
+
+
+def _fetch(url: str, out: IO[bytes]) -> bytes:
+    """stream `url` into `out`, returning the sha256 digest"""
+    # same approach as `hashlib.file_digest`: read into a single reused
+    # buffer and hand slices of it to OpenSSL (which uses SHA-NI if available)
+    import hashlib
+
+    sha256 = hashlib.sha256()
+    buf = bytearray(_CHUNK_SIZE)
+    view = memoryview(buf)
+    with _urlopen(url) as resp:
+        while size := resp.readinto(buf):
+            sha256.update(view[:size])
+            out.write(view[:size])
+    return sha256.digest()
+
+
+@contextlib.contextmanager
+def _atomic(dest: str) -> Generator[str, None, None]:
+    """yield a temporary path which is moved to `dest` only on success"""
+    import secrets
+
+    tmp = f'{dest}.{secrets.token_hex(4)}.tmp'
+    try:
+        yield tmp
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+    else:
+        os.replace(tmp, dest)
+
+
+def _link_or_copy(src: str, dest: str) -> None:
+    # renaming over another name for the same inode is a no-op which would
+    # leave the temporary file behind
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+
+    with _atomic(dest) as tmp:
+        try:
+            os.link(src, tmp)
+        except OSError:  # pragma: no cover (cross-device or unsupported)
+            shutil.copyfile(src, tmp)
+
+
+def _download(f: File, base: str, cache: str) -> None:
+    import secrets
+
+    # the checksum identifies the content so a cached copy can be reused
+    cached = os.path.join(cache, f.sha256)
+    if not os.path.exists(cached):
+        with _atomic(cached) as tmp:
+            with open(tmp, 'wb') as fb:
+                digest = _fetch(f.url, fb)
+
+            if not secrets.compare_digest(digest, bytes.fromhex(f.sha256)):
+                got = digest.hex()
+                raise ValueError(
+                    f'{f.path}: checksum mismatch {got=} {f.sha256=}',
+                )
 
     dest = os.path.join(base, f.path)
-    os.makedirs(os.path.dirname(dest), exist_ok=True)
-    with open(dest, 'wb') as fb:
-        fb.write(contents)
+    if f.archive.strategy == 'noop':
+        _link_or_copy(cached, dest)
+    else:
+        # extract from the verified copy on disk rather than buffering it
+        with open(cached, 'rb') as fb:
+            contents = _EXTRACT[f.archive.strategy](fb, f.archive.path)
+        with _atomic(dest) as tmp, open(tmp, 'wb') as fb:
+            fb.write(contents)
+
+
+def _download_all(jobs: list[tuple[File, str]], cache: str) -> None:
+    for f, base in jobs:
+        _download(f, base, cache)
+
+
+def _makedirs(dirs: Iterable[str]) -> None:
+    # many files share parents: only create each directory once up front
+    for d in sorted(set(dirs)):
+        os.makedirs(d, exist_ok=True)
+
+
+def _install(src: str, dest: str, executable: bool) -> None:
+    # always copy: `src` may share an inode with the download cache which
+    # must not be changed by (or after) installation
+    with _atomic(dest) as tmp:
+        shutil.copyfile(src, tmp)
+        if executable:
+            os.chmod(tmp, 0o755)
 
 
 def _init_options(cmd: Command, options: tuple[tuple[str, str], ...]) -> None:
@@ -235,6 +507,7 @@ class setuptools_download(Command):
     user_options = [
         ('download-data-files=', None, ''),
         ('download-scripts=', None, ''),
+        ('download-cache=', None, ''),
     ]
 
     def initialize_options(self) -> None:
@@ -244,6 +517,8 @@ class setuptools_download(Command):
         self.download_scripts: str | None = None
         self.parsed_scripts: tuple[File, ...] | None = None
 
+        self.download_cache: str | None = None
+
         self.build_temp: str | None = None
         self.download_dir: str | None = None
 
@@ -257,9 +532,12 @@ class setuptools_download(Command):
         _init_options(self, (('build', 'build_temp'),))
         assert self.build_temp is not None
         self.download_dir = os.path.join(self.build_temp, 'download')
+        if self.download_cache is None:
+            self.download_cache = os.path.join(self.download_dir, '.cache')
 
     def run(self) -> None:
         assert self.download_dir is not None
+        assert self.download_cache is not None
         assert self.parsed_data_files is not None
         assert self.parsed_scripts is not None
 
@@ -268,11 +546,37 @@ class setuptools_download(Command):
             ('scripts', self.parsed_scripts),
         )
 
+        # files sharing a checksum (such as several paths extracted from one
+        # archive) are handled by a single worker so they're fetched once
+        by_sha256: dict[str, list[tuple[File, str]]] = {}
         for subdir, files in todo:
             base = os.path.join(self.download_dir, subdir)
             for f in files:
-                print(f'=> downloading {f.path}...')
-                _download(f, base)
+                by_sha256.setdefault(f.sha256, []).append((f, base))
+        groups = list(by_sha256.values())
+
+        _makedirs((
+            self.download_cache,
+            *(
+                os.path.dirname(os.path.join(base, f.path))
+                for group in groups
+                for f, base in group
+            ),
+        ))
+
+        # threads are only spawned as jobs are submitted
+        try:
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                futures = [
+                    executor.submit(_download_all, group, self.download_cache)
+                    for group in groups
+                ]
+                for group, future in zip(groups, futures):
+                    for f, _ in group:
+                        print(f'=> downloading {f.path}...')
+                    future.result()
+        finally:
+            _close_idle_connections()
 
 
 class install_setuptools_download(Command):
@@ -302,22 +606,28 @@ class install_setuptools_download(Command):
         assert self.install_data is not None
         assert self.install_scripts is not None
 
-        for f in self.parsed_data_files:
-            src = os.path.join(self.download_dir, 'data_files', f.path)
-            dest = os.path.join(self.install_data, f.path)
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-            shutil.copy(src, dest)
-
-        for f in self.parsed_scripts:
-            src = os.path.join(self.download_dir, 'scripts', f.path)
-            dest = os.path.join(self.install_scripts, f.path)
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-            shutil.copy(src, dest)
-
-            # make scripts executable
-            mode = os.stat(dest).st_mode
-            mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-            os.chmod(dest, mode)
+        jobs = [
+            (
+                os.path.join(self.download_dir, 'data_files', f.path),
+                os.path.join(self.install_data, f.path),
+                False,
+            )
+            for f in self.parsed_data_files
+        ]
+        jobs.extend(
+            (
+                os.path.join(self.download_dir, 'scripts', f.path),
+                os.path.join(self.install_scripts, f.path),
+                True,
+            )
+            for f in self.parsed_scripts
+        )
+        _makedirs(os.path.dirname(dest) for _, dest, _ in jobs)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(_install, *job) for job in jobs]
+            for future in futures:
+                future.result()
 
 
 def finalize_distribution(dist: Distribution) -> None:
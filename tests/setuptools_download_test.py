@@ -1,24 +1,33 @@
 from __future__ import annotations
 
 import hashlib
+import http.server
 import io
 import os
 import subprocess
 import sys
 import tarfile
+import threading
 import time
+import urllib.error
 import urllib.request
 import zipfile
 from typing import NamedTuple
+from unittest import mock
 
 import ephemeral_port_reserve
 import pytest
 import re_assert
+from setuptools import Distribution
 
-from setuptools_download import _extract_noop
+import setuptools_download
+from setuptools_download import _close_idle_connections
+from setuptools_download import _default_env
+from setuptools_download import _download
 from setuptools_download import _extract_tar
 from setuptools_download import _extract_zip
 from setuptools_download import _filter
+from setuptools_download import _install
 from setuptools_download import _parse
 from setuptools_download import Archive
 from setuptools_download import File
@@ -65,25 +74,74 @@ def test_marker_parse_invalid(s):
     )
 
 
-def test_extract_noop():
-    assert _extract_noop(b'file contents', '') == b'file contents'
+@pytest.mark.parametrize(
+    ('s', 'expected'),
+    (
+        ('_internal == "hellohello"', True),
+        ('_internal == "never"', False),
+        (f'_internal == "hellohello" and os_name == "{os.name}"', True),
+        ('_internal == "hellohello" and _internal == "never"', False),
+    ),
+)
+def test_marker_evaluate(s, expected):
+    assert Marker.parse(s).evaluate(_default_env()) is expected
 
 
 def test_extract_zip():
     bio = io.BytesIO()
     with zipfile.ZipFile(bio, 'w') as zipf:
         zipf.writestr('example/file', b'file contents')
-    assert _extract_zip(bio.getvalue(), 'example/file') == b'file contents'
+    assert _extract_zip(bio, 'example/file') == b'file contents'
+
+
+def _tar(mode, files):
+    bio = io.BytesIO()
+    with tarfile.open(fileobj=bio, mode=mode) as tarf:
+        for name, contents in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            tarf.addfile(info, io.BytesIO(contents))
+    return bio.getvalue()
+
 
+@pytest.mark.parametrize('mode', ('w', 'w:gz', 'w:bz2'))
+def test_extract_tar(mode):
+    bts = _tar(mode, (('example/file', b'file contents'),))
+    assert _extract_tar(io.BytesIO(bts), 'example/file') == b'file contents'
 
-def test_extract_tar():
+
+def test_extract_tar_duplicate_member_uses_last():
+    bts = _tar('w:gz', (('example/file', b'old'), ('example/file', b'new')))
+    assert _extract_tar(io.BytesIO(bts), 'example/file') == b'new'
+
+
+@pytest.mark.parametrize(
+    ('linktype', 'linkname'),
+    (
+        pytest.param(tarfile.SYMTYPE, 'tool-1.0', id='symlink'),
+        pytest.param(tarfile.LNKTYPE, 'bin/tool-1.0', id='hardlink'),
+    ),
+)
+def test_extract_tar_link_member(linktype, linkname):
     bio = io.BytesIO()
     with tarfile.open(fileobj=bio, mode='w:gz') as tarf:
-        fileobj = io.BytesIO(b'file contents')
-        info = tarfile.TarInfo('example/file')
-        info.size = len(fileobj.getvalue())
-        tarf.addfile(info, fileobj)
-    assert _extract_tar(bio.getvalue(), 'example/file') == b'file contents'
+        info = tarfile.TarInfo('bin/tool-1.0')
+        info.size = len(b'file contents')
+        tarf.addfile(info, io.BytesIO(b'file contents'))
+
+        link = tarfile.TarInfo('bin/tool')
+        link.type = linktype
+        link.linkname = linkname
+        tarf.addfile(link)
+
+    bio.seek(0)
+    assert _extract_tar(bio, 'bin/tool') == b'file contents'
+
+
+def test_extract_tar_missing():
+    bts = _tar('w:gz', (('example/file', b'file contents'),))
+    with pytest.raises(KeyError):
+        _extract_tar(io.BytesIO(bts), 'example/other')
 
 
 @pytest.mark.parametrize('s', ('', None))
@@ -148,6 +206,23 @@ marker = sys_platform == "linux"
     )
 
 
+def test_parse_blank_lines_between_sections():
+    src = '''\
+[f1]
+url = https://example.com/f1
+sha256 = deadbeef
+
+[f2]
+url = https://example.com/f2
+sha256 = cafecafe
+'''
+    ret = _parse(src, 'example')
+    assert ret == (
+        File(path='f1', url='https://example.com/f1', sha256='deadbeef'),
+        File(path='f2', url='https://example.com/f2', sha256='cafecafe'),
+    )
+
+
 def test_parse_unexpected_leading_text():
     src = '''\
 junk
@@ -172,6 +247,19 @@ wat = 1
     assert msg == 'example[f1]wat: unexpected key'
 
 
+def test_parse_missing_equals():
+    src = '''\
+[f1]
+url https://example.com/f1
+'''
+    with pytest.raises(ValueError) as excinfo:
+        _parse(src, 'example')
+    msg, = excinfo.value.args
+    assert msg == (
+        'example[f1]url https://example.com/f1: expected `key = value`'
+    )
+
+
 def test_parse_duplicate_key():
     src = '''\
 [f1]
@@ -199,6 +287,19 @@ def test_parse_missing_url_or_sha256(s):
     assert msg == 'example[f1]: missing `url` + `sha256`'
 
 
+@pytest.mark.parametrize('sha256', ('../../f1', '', 'de ad', 'abc'))
+def test_parse_sha256_not_hex(sha256):
+    src = f'''\
+[f1]
+url = https://example.com/f1
+sha256 = {sha256}
+'''
+    with pytest.raises(ValueError) as excinfo:
+        _parse(src, 'example')
+    msg, = excinfo.value.args
+    assert msg == f'example[f1]sha256: expected hex digest, got {sha256!r}'
+
+
 @pytest.mark.parametrize(
     's',
     (
@@ -211,6 +312,12 @@ def test_parse_missing_url_or_sha256(s):
         'url = https://example.com/f1.tar.gz\n'
         'sha256=deadbeef\n'
         'extract_path = release-1.0/f1\n',
+
+        '[f1]\n'
+        'url = https://example.com/f1.tar.gz\n'
+        'sha256=deadbeef\n'
+        'extract = tar\n'
+        'extract_path =\n',
     ),
 )
 def test_parse_missing_extract_or_extract_path(s):
@@ -220,18 +327,21 @@ def test_parse_missing_extract_or_extract_path(s):
     assert msg == 'example[f1]: missing `extract` + `extract_path`'
 
 
-def test_parse_unexpected_extract_type():
-    src = '''\
+@pytest.mark.parametrize('extract', ('ar', 'noop'))
+def test_parse_unexpected_extract_type(extract):
+    src = f'''\
 [f1]
 url = https://example.com/f1.ar
 sha256 = deadbeef
-extract = ar
+extract = {extract}
 extract_path = release-v1.0/f1
 '''
     with pytest.raises(ValueError) as excinfo:
         _parse(src, 'example')
     msg, = excinfo.value.args
-    assert msg == "example[f1]extract: unexpected value 'ar', (tar, zip)"
+    assert msg == (
+        f"example[f1]extract: unexpected value {extract!r}, (tar, zip)"
+    )
 
 
 @pytest.mark.parametrize(
@@ -340,6 +450,19 @@ def test_filter_missing_file_for_group():
     ).assert_matches(msg)
 
 
+def test_install_does_not_share_inode_with_src(tmp_path):
+    src = tmp_path.joinpath('src')
+    src.write_bytes(b'hello hello')
+    mode_before = src.stat().st_mode
+    dest = tmp_path.joinpath('dest')
+
+    _install(str(src), str(dest), True)
+
+    assert dest.read_bytes() == b'hello hello'
+    assert src.stat().st_nlink == 1
+    assert src.stat().st_mode == mode_before
+
+
 def _sha256(f):
     with open(f, 'rb') as f:
         return hashlib.sha256(f.read()).hexdigest()
@@ -361,9 +484,15 @@ def file_server(tmp_path_factory):
     plain.write_bytes(b'hello hello')
     plain_sha256 = _sha256(plain)
 
+    # http.server redirects `/redirect` => `/redirect/` => `index.html`
+    redirect = tmp_path.joinpath('redirect')
+    redirect.mkdir()
+    redirect.joinpath('index.html').write_bytes(b'hello hello')
+
     archive = tmp_path.joinpath('archive.zip')
     with zipfile.ZipFile(archive, 'w') as zipf:
         zipf.writestr('path/to/f1', 'hello hello')
+        zipf.writestr('path/to/f2', 'hello f2')
     archive_sha256 = _sha256(archive)
 
     bin_posix = tmp_path.joinpath('bin')
@@ -409,6 +538,197 @@ def file_server(tmp_path_factory):
         proc.wait()
 
 
+@pytest.fixture(autouse=True)
+def close_idle_connections():
+    yield
+    _close_idle_connections()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    ret = tmp_path.joinpath('.cache')
+    ret.mkdir()
+    return str(ret)
+
+
+def test_download_follows_redirects(file_server, tmp_path, cache):
+    f = File(
+        path='f',
+        url=f'{file_server.host}/redirect',
+        sha256=file_server.plain_sha256,
+    )
+    _download(f, str(tmp_path), cache)
+    assert tmp_path.joinpath('f').read_bytes() == b'hello hello'
+
+
+def test_download_file_url(tmp_path, cache):
+    src = tmp_path.joinpath('src')
+    src.write_bytes(b'hello hello')
+    f = File(
+        path='f',
+        url=src.as_uri(),
+        sha256=hashlib.sha256(b'hello hello').hexdigest(),
+    )
+    _download(f, str(tmp_path), cache)
+    assert tmp_path.joinpath('f').read_bytes() == b'hello hello'
+
+
+def test_download_twice_leaves_no_temporary_files(
+        file_server, tmp_path, cache,
+):
+    base = tmp_path.joinpath('base')
+    base.mkdir()
+    f = File(
+        path='f',
+        url=f'{file_server.host}/plain',
+        sha256=file_server.plain_sha256,
+    )
+    _download(f, str(base), cache)
+    _download(f, str(base), cache)
+    assert os.listdir(base) == ['f']
+
+
+def test_download_uses_cache(file_server, tmp_path, cache):
+    f = File(
+        path='f1',
+        url=f'{file_server.host}/plain',
+        sha256=file_server.plain_sha256,
+    )
+    _download(f, str(tmp_path), cache)
+
+    # the url no longer exists but the content is already known
+    f = f._replace(path='f2', url=f'{file_server.host}/missing')
+    _download(f, str(tmp_path), cache)
+    assert tmp_path.joinpath('f2').read_bytes() == b'hello hello'
+
+
+def test_run_fetches_shared_archive_once(file_server, tmp_path):
+    cmd = setuptools_download.setuptools_download(Distribution())
+    cmd.download_dir = str(tmp_path)
+    cmd.download_cache = str(tmp_path.joinpath('.cache'))
+    cmd.parsed_data_files = tuple(
+        File(
+            path=name,
+            url=f'{file_server.host}/archive.zip',
+            sha256=file_server.archive_sha256,
+            archive=Archive(strategy='zip', path=f'path/to/{name}'),
+        )
+        for name in ('f1', 'f2')
+    )
+    cmd.parsed_scripts = ()
+
+    fetch = mock.Mock(wraps=setuptools_download._fetch)
+    with mock.patch.object(setuptools_download, '_fetch', fetch):
+        cmd.run()
+
+    assert fetch.call_count == 1
+    data_files = tmp_path.joinpath('data_files')
+    assert data_files.joinpath('f1').read_bytes() == b'hello hello'
+    assert data_files.joinpath('f2').read_bytes() == b'hello f2'
+
+
+def test_download_too_many_redirects(file_server, tmp_path, cache):
+    f = File(
+        path='f',
+        url=f'{file_server.host}/redirect',
+        sha256=file_server.plain_sha256,
+    )
+    with mock.patch.object(setuptools_download, '_MAX_REDIRECTS', 1):
+        with pytest.raises(ValueError) as excinfo:
+            _download(f, str(tmp_path), cache)
+    msg, = excinfo.value.args
+    assert msg == f'{file_server.host}/redirect/: too many redirects'
+
+
+def test_download_archive_checksum_mismatch(file_server, tmp_path, cache):
+    f = File(
+        path='f',
+        url=f'{file_server.host}/archive.zip',
+        sha256='deadbeef',
+        archive=Archive(strategy='zip', path='path/to/f1'),
+    )
+    with pytest.raises(ValueError) as excinfo:
+        _download(f, str(tmp_path), cache)
+    msg, = excinfo.value.args
+    assert msg == (
+        f"f: checksum mismatch got='{file_server.archive_sha256}' "
+        f"f.sha256='deadbeef'"
+    )
+    assert not tmp_path.joinpath('f').exists()
+    assert os.listdir(tmp_path.joinpath('.cache')) == []
+
+
+def test_download_http_error(file_server, tmp_path, cache):
+    f = File(
+        path='f',
+        url=f'{file_server.host}/missing',
+        sha256=file_server.plain_sha256,
+    )
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        _download(f, str(tmp_path), cache)
+    assert excinfo.value.code == 404
+    # no partial files are left behind
+    assert os.listdir(tmp_path.joinpath('.cache')) == []
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    responses_by_path = {
+        '/ftp': (302, {'Location': 'ftp://example.com/f'}, b''),
+        '/no-location': (302, {}, b''),
+        '/non-authoritative': (203, {}, b'hello hello'),
+    }
+
+    def do_GET(self):
+        status, headers, body = self.responses_by_path[self.path]
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def custom_server():
+    with http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler) as srv:
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        try:
+            yield f'http://127.0.0.1:{srv.server_address[1]}'
+        finally:
+            srv.shutdown()
+            thread.join()
+
+
+def test_download_redirect_to_other_scheme(custom_server, tmp_path, cache):
+    f = File(path='f', url=f'{custom_server}/ftp', sha256='deadbeef')
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        _download(f, str(tmp_path), cache)
+    assert excinfo.value.code == 302
+    assert excinfo.value.url == f'{custom_server}/ftp'
+    assert "Redirection to url 'ftp://example.com/f'" in excinfo.value.msg
+
+
+def test_download_redirect_without_location(custom_server, tmp_path, cache):
+    f = File(path='f', url=f'{custom_server}/no-location', sha256='deadbeef')
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        _download(f, str(tmp_path), cache)
+    assert excinfo.value.code == 302
+
+
+def test_download_any_2xx_status(custom_server, tmp_path, cache):
+    f = File(
+        path='f',
+        url=f'{custom_server}/non-authoritative',
+        sha256=hashlib.sha256(b'hello hello').hexdigest(),
+    )
+    _download(f, str(tmp_path), cache)
+    assert tmp_path.joinpath('f').read_bytes() == b'hello hello'
+
+
 _SETUP_PY = 'from setuptools import setup; setup(name="t", version="1")'
 
 
@@ -433,6 +753,28 @@ download_data_files =
         zipf.read('t-1.data/data/share/example/f') == b'hello hello'
 
 
+def test_integration_download_cache(file_server, tmp_path):
+    cache = tmp_path.joinpath('cache')
+    setup_cfg = f'''\
+[setuptools_download]
+download_cache = {cache}
+download_data_files =
+    [share/example/f]
+    url = {file_server.host}/plain
+    sha256 = {file_server.plain_sha256}
+'''
+    tmp_path.joinpath('setup.cfg').write_text(setup_cfg)
+    tmp_path.joinpath('setup.py').write_text(_SETUP_PY)
+
+    subprocess.check_call(
+        (sys.executable, '-m', 'build', '--no-isolation', '--wheel'),
+        cwd=tmp_path,
+    )
+
+    cached = cache.joinpath(file_server.plain_sha256)
+    assert cached.read_bytes() == b'hello hello'
+
+
 def test_integration_checksum_mismatch(file_server, tmp_path):
     setup_cfg = f'''\
 [setuptools_download]